@@ -1,19 +1,56 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-import google.generativeai as genai
-import json
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from google import genai
+from google.genai import types
+import orjson
+import simdjson
 import os
+import anyio
 import asyncio
+import atexit
+import logging
+import logging.handlers
+import queue
+import hashlib
+import random
 import re
+import threading
+import time
+import numpy as np
+from cachetools import TTLCache, cached
+from collections import Counter, OrderedDict
+from contextlib import aclosing
 from typing import List, Optional
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(title="Exam Paper Generator API")
+# Logging - records are queued and written by a background thread, off the event loop
+log = logging.getLogger("papervista")
+log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+log.propagate = False
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(message)s"))
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+app = FastAPI(title="Exam Paper Generator API", default_response_class=ORJSONResponse)
+
+# Per-IP rate limit on the generation endpoints
+RATE_LIMIT = os.getenv("RATE_LIMIT", "10/minute")
+limiter = Limiter(key_func=get_remote_address)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 # Configure CORS
 frontend_url = os.getenv("FRONTEND_URL", "https://paper-vista-five.vercel.app")
@@ -34,7 +71,8 @@ app.add_middleware(
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable is not set")
-genai.configure(api_key=GEMINI_API_KEY)
+# One async client per process so HTTP connections are reused across requests
+client = genai.Client(api_key=GEMINI_API_KEY, http_options=types.HttpOptions(timeout=60000))
 
 # Model fallback list - VERIFIED models that work with free tier
 MODEL_FALLBACK_LIST = [
@@ -46,20 +84,160 @@ MODEL_FALLBACK_LIST = [
 # Timeout for API calls (in seconds)
 GENERATION_TIMEOUT = 45
 
+# Time budget for retrying a single question before using the fallback question (in seconds);
+# room for one timed-out attempt plus a retry on another model
+RETRY_DEADLINE = 2 * GENERATION_TIMEOUT
+
+# How long the /health model listing is cached (in seconds)
+MODEL_LIST_TTL = 5 * 60
+
+# Context cache lifetime and refresh interval (refresh before the TTL expires)
+PROMPT_CACHE_TTL = "3600s"
+PROMPT_CACHE_REFRESH_SECONDS = 55 * 60
+
+# Gemini's minimum size for explicit context caching (in tokens)
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Static prompt scaffold - identical for every request, so it is registered
+# once as Gemini cached content and only the variable part is sent per call
+STATIC_RULES = """You are an exam paper generator.
+You must generate ONLY valid JSON. No markdown, no explanations, no code blocks.
+
+Question requests:
+- Return ONLY one JSON question object
+
+Paper requests:
+- Return ONLY a JSON array with one question object per listed question, in order
+
+For every question:
+- Part a: Basic definition
+- Part b: Explanation
+- Part c: Application with hasOR=true and orText
+- Use the marks given in the request for each part
+- Make questions specific to the given topic"""
+
+SCHEMA_EXAMPLE = """Question format:
+{
+  "questionNumber": 1,
+  "parts": [
+    {"label": "a", "text": "Define <topic>", "marks": 3},
+    {"label": "b", "text": "Explain <topic>", "marks": 3},
+    {"label": "c", "text": "Apply <topic>", "marks": 4, "hasOR": true, "orText": "Analyze <topic>"}
+  ]
+}"""
+
+# Worker threads for blocking calls (anyio's default is 40). Generation is async and
+# needs no threads; each thread reserves ~8 MB of stack, so raise this only if needed
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", 40))
+
+# Maximum concurrent Gemini generation calls (shared by all requests)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", 3))
+_GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# Maximum papers generated at once per worker; extra requests get 429 instead of queuing
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", 8))
+_INFLIGHT = asyncio.Semaphore(MAX_INFLIGHT)
+
+# Cached content name per model, filled in the background after startup
+CACHES = {}
+
+# Models that can never hold the cache (scaffold too small, model missing, no access);
+# the refresher stops once every model is in here
+_UNCACHEABLE = set()
+
+# Response cache - repeated course/exam/topic requests skip generation
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 6 * 60 * 60))
+SEMANTIC_CACHE_THRESHOLD = 0.95
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_TIMEOUT = 1.5  # seconds; a slow embedding just means no semantic match
+_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+_CACHE_LOCK = asyncio.Lock()
+
+# Pending generations by cache key (single-flight for identical requests)
+_SINGLE_FLIGHT: "dict[str, dict]" = {}
+
 # Function to list available models (for debugging)
+@cached(TTLCache(maxsize=1, ttl=MODEL_LIST_TTL), lock=threading.Lock())
+def fetch_available_models():
+    """Fetch generateContent-capable models (cached so /health stays fast)"""
+    models = [m for m in client.models.list() if 'generateContent' in (m.supported_actions or [])]
+    log.info("📚 Available Gemini Models: %s", ", ".join(m.name for m in models))
+    return [m.name.replace('models/', '') for m in models]
+
 def list_available_models():
     """List all available Gemini models"""
     try:
-        models = genai.list_models()
-        print("\n📚 Available Gemini Models:")
-        for model in models:
-            if 'generateContent' in model.supported_generation_methods:
-                print(f"  ✅ {model.name}")
-        return [m.name.replace('models/', '') for m in models if 'generateContent' in m.supported_generation_methods]
+        return fetch_available_models()
     except Exception as e:
-        print(f"❌ Could not list models: {e}")
+        log.error("❌ Could not list models: %s", e)
         return []
 
+def build_config(model_name: str, generation_config: types.GenerateContentConfig) -> types.GenerateContentConfig:
+    """Bind a config to the cached scaffold, or carry the scaffold inline if uncached"""
+    cache_name = CACHES.get(model_name)
+    if cache_name is not None:
+        return generation_config.model_copy(update={"cached_content": cache_name})
+    return generation_config.model_copy(
+        update={"system_instruction": f"{STATIC_RULES}\n\n{SCHEMA_EXAMPLE}"}
+    )
+
+async def refresh_prompt_caches():
+    """Create missing caches and extend the TTL of existing ones"""
+    for model_name in MODEL_FALLBACK_LIST:
+        if model_name in _UNCACHEABLE:
+            continue
+        cache_name = CACHES.get(model_name)
+        try:
+            if cache_name is not None:
+                await client.aio.caches.update(
+                    name=cache_name,
+                    config=types.UpdateCachedContentConfig(ttl=PROMPT_CACHE_TTL)
+                )
+            else:
+                # Gemini rejects caches below a minimum size; don't attempt those
+                count = await client.aio.models.count_tokens(
+                    model=model_name,
+                    contents=[STATIC_RULES, SCHEMA_EXAMPLE]
+                )
+                if (count.total_tokens or 0) < PROMPT_CACHE_MIN_TOKENS:
+                    _UNCACHEABLE.add(model_name)
+                    log.info(
+                        "🗄️ Prompt scaffold for %s is %s tokens (< %d); sending it as a system instruction",
+                        model_name, count.total_tokens, PROMPT_CACHE_MIN_TOKENS
+                    )
+                    continue
+                cache = await client.aio.caches.create(
+                    model=model_name,
+                    config=types.CreateCachedContentConfig(
+                        display_name="papervista-static-prompt",
+                        system_instruction=STATIC_RULES,
+                        contents=[SCHEMA_EXAMPLE],
+                        ttl=PROMPT_CACHE_TTL
+                    )
+                )
+                CACHES[model_name] = cache.name
+                log.info("🗄️ Prompt cache created for %s", model_name)
+        except Exception as e:
+            # Unsupported models keep receiving the scaffold as a system instruction;
+            # transient failures (or an expired cache) are retried on the next refresh,
+            # while models that can never be cached are not tried again
+            CACHES.pop(model_name, None)
+            error_msg = str(e).lower()
+            if cache_name is None and (
+                    is_fatal_error(e) or "404" in error_msg or "not found" in error_msg
+                    or "not_found" in error_msg or "too small" in error_msg):
+                _UNCACHEABLE.add(model_name)
+            log.warning("⚠️ Prompt cache unavailable for %s: %.150s", model_name, e)
+
+async def prompt_cache_refresher():
+    """Background task that creates the prompt caches and keeps them alive"""
+    while True:
+        await refresh_prompt_caches()
+        if all(model_name in _UNCACHEABLE for model_name in MODEL_FALLBACK_LIST):
+            return
+        await asyncio.sleep(PROMPT_CACHE_REFRESH_SECONDS)
+
 # Models
 class QuestionRequest(BaseModel):
     courseName: str
@@ -77,6 +255,67 @@ class Question(BaseModel):
     questionNumber: int
     parts: List[QuestionPart]
 
+# Response schemas for Gemini structured output (the schema format has no defaults)
+class QuestionPartOut(BaseModel):
+    label: str
+    text: str
+    marks: int
+    hasOR: Optional[bool]
+    orText: Optional[str]
+
+class QuestionOut(BaseModel):
+    questionNumber: int
+    parts: List[QuestionPartOut]
+
+# Generation settings - constant, so built once
+_CONTENT_CFG = types.GenerateContentConfig(
+    temperature=0.5,
+    max_output_tokens=1000,
+    candidate_count=1,
+    response_mime_type="application/json",
+    response_schema=QuestionOut
+)
+
+# Whole-paper batch: up to 5 questions of ~1000 tokens each
+_BATCH_CFG = types.GenerateContentConfig(
+    temperature=0.5,
+    max_output_tokens=5 * 1000,
+    candidate_count=1,
+    response_mime_type="application/json",
+    response_schema=list[QuestionOut]
+)
+
+# Precompiled patterns for JSON cleanup
+_RE_TRAIL_COMMA = re.compile(r',(\s*[}\]])')
+_RE_LINE_COMMENT = re.compile(r'//.*?\n')
+_RE_BLOCK_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+
+def _find_json_blobs(text: str):
+    """Yield balanced top-level {...} / [...] spans in one linear pass (no regex backtracking)"""
+    depth = 0
+    start = -1
+    in_string = False
+    escaped = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            # Quotes outside a JSON value are prose, not strings
+            in_string = depth > 0
+        elif c in '{[':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c in '}]' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield text[start:i + 1]
+
 # Enhanced JSON cleaning function
 def clean_and_parse_json(response_text: str) -> dict:
     """
@@ -84,61 +323,103 @@ def clean_and_parse_json(response_text: str) -> dict:
     """
     try:
         # Log the raw response for debugging
-        print(f"📦 Raw response (first 500 chars): {response_text[:500]}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("📦 Raw response (first 500 chars): %.500s", response_text)
         
         # Step 1: Remove markdown code blocks
-        response_text = re.sub(r'```json\s*', '', response_text)
-        response_text = re.sub(r'```\s*', '', response_text)
-        
-        # Step 2: Remove any text before the first { or [
-        match = re.search(r'[\[{]', response_text)
-        if match:
-            response_text = response_text[match.start():]
+        response_text = response_text.replace("```json", "").replace("```", "")
         
-        # Step 3: Remove any text after the last } or ]
-        match = re.search(r'[}\]](?=[^}\]]*$)', response_text)
-        if match:
-            response_text = response_text[:match.end()]
+        # Step 2: Keep only the text between the first { or [ and the last } or ]
+        starts = [i for i in (response_text.find('['), response_text.find('{')) if i >= 0]
+        end = max(response_text.rfind(']'), response_text.rfind('}')) + 1
+        if starts and end > min(starts):
+            response_text = response_text[min(starts):end]
         
-        # Step 4: Remove trailing commas before ] or }
-        response_text = re.sub(r',(\s*[}\]])', r'\1', response_text)
-        
-        # Step 5: Remove comments (// and /* */)
-        response_text = re.sub(r'//.*?\n', '\n', response_text)
-        response_text = re.sub(r'/\*.*?\*/', '', response_text, flags=re.DOTALL)
-        
-        # Step 6: Clean up whitespace
-        response_text = response_text.strip()
-        
-        # Step 7: Try to parse
-        parsed = json.loads(response_text)
-        print(f"✅ Successfully parsed JSON")
+        # Step 3: Try to parse
+        parsed = orjson.loads(response_text.strip())
+        log.debug("✅ Successfully parsed JSON")
         return parsed
         
-    except json.JSONDecodeError as e:
-        print(f"❌ JSON Parse Error: {str(e)}")
-        print(f"📄 Cleaned text (first 500 chars): {response_text[:500]}")
+    except orjson.JSONDecodeError as e:
+        log.warning("❌ JSON Parse Error: %s", e)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("📄 Cleaned text (first 500 chars): %.500s", response_text)
         
-        # Last resort: try to extract JSON using regex
+        # Last resort: strip trailing commas and comments, then re-parse
         try:
-            # Find the main JSON structure
-            json_pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}|\[[^\[\]]*(?:\[[^\[\]]*\][^\[\]]*)*\]'
-            matches = re.findall(json_pattern, response_text, re.DOTALL)
+            response_text = _RE_TRAIL_COMMA.sub(r'\1', response_text)
+            response_text = _RE_LINE_COMMENT.sub('\n', response_text)
+            response_text = _RE_BLOCK_COMMENT.sub('', response_text)
             
-            if matches:
-                # Try each match
-                for match in matches:
-                    try:
-                        return json.loads(match)
-                    except:
-                        continue
+            parsed = simdjson.Parser().parse(response_text.strip().encode())
+            if isinstance(parsed, simdjson.Object):
+                return parsed.as_dict()
+            if isinstance(parsed, simdjson.Array):
+                return parsed.as_list()
+            return parsed
         except Exception as fallback_error:
-            print(f"❌ Fallback parsing also failed: {str(fallback_error)}")
+            log.warning("❌ Fallback parsing also failed: %s", fallback_error)
+        
+        # Finally, try each balanced JSON value embedded in the text
+        for blob in _find_json_blobs(response_text):
+            try:
+                return orjson.loads(blob)
+            except orjson.JSONDecodeError:
+                continue
         
         raise ValueError(f"Unable to parse JSON from response. Error: {str(e)}")
 
+# Structured-output responses are strict JSON; only clean up when they are not
+def parse_model_json(response_text: str):
+    """Parse a model response, falling back to the cleaning parser on malformed JSON"""
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        return clean_and_parse_json(response_text)
+
+# Stream a response and stop as soon as a complete JSON object has arrived
+async def collect_stream(model_name: str, prompt: str, generation_config: types.GenerateContentConfig, on_text=None) -> str:
+    """Accumulate streamed chunks (reporting progress and the model to on_text), returning early once the JSON closes"""
+    stream = await client.aio.models.generate_content_stream(
+        model=model_name,
+        contents=prompt,
+        config=build_config(model_name, generation_config)
+    )
+    text = ""
+    async with aclosing(stream):
+        async for chunk in stream:
+            text += chunk.text or ""
+            if on_text is not None:
+                on_text(text, model_name)
+            if (text.rstrip().endswith(('}', ']'))
+                    and text.count('{') == text.count('}')
+                    and text.count('[') == text.count(']')):
+                break
+    return text
+
+def is_quota_error(e: Exception) -> bool:
+    """Whether an API error means the model's quota or rate limit is exhausted"""
+    error_msg = str(e).lower()
+    return any(keyword in error_msg for keyword in ["429", "quota", "rate limit", "resource exhausted", "resource_exhausted"])
+
+def is_model_unavailable(e: Exception) -> bool:
+    """Whether a model is missing or not answering (another model may still work)"""
+    error_msg = str(e).lower()
+    return any(keyword in error_msg for keyword in ["404", "not found", "not_found", "invalid model", "model not available", "timed out"])
+
+def is_fatal_error(e: Exception) -> bool:
+    """Whether an API error cannot be fixed by retrying or switching models (e.g. a bad API key)"""
+    error_msg = str(e).lower()
+    return any(keyword in error_msg for keyword in ["api key", "api_key_invalid", "permission_denied", "401", "403"])
+
+def next_model(model_name: str) -> str:
+    """The model after model_name in the fallback list (wrapping around)"""
+    if model_name not in MODEL_FALLBACK_LIST:
+        return MODEL_FALLBACK_LIST[0]
+    return MODEL_FALLBACK_LIST[(MODEL_FALLBACK_LIST.index(model_name) + 1) % len(MODEL_FALLBACK_LIST)]
+
 # Helper function to generate content with model fallback
-async def generate_with_fallback(prompt: str, generation_config: dict, model_name: str = None):
+async def generate_with_fallback(prompt: str, generation_config: types.GenerateContentConfig, model_name: str = None, on_text=None, timeout: float = GENERATION_TIMEOUT):
     """Try multiple models in sequence until one succeeds"""
     last_error = None
     attempt = 0
@@ -148,54 +429,51 @@ async def generate_with_fallback(prompt: str, generation_config: dict, model_nam
     for current_model in models_to_try:
         try:
             attempt += 1
-            print(f"🔄 Attempt {attempt}: Using model {current_model}")
-            
-            model = genai.GenerativeModel(current_model)
+            log.info("🔄 Attempt %d: Using model %s", attempt, current_model)
             
-            # Use threadpool to prevent blocking and add timeout protection
-            response = await asyncio.wait_for(
-                run_in_threadpool(
-                    model.generate_content,
-                    prompt,
-                    generation_config=generation_config
-                ),
-                timeout=GENERATION_TIMEOUT
-            )
+            # Native async call with timeout protection; the concurrency slot is held
+            # for this attempt only, never across the fallback walk or retry backoff
+            async with _GEMINI_SEM:
+                text = await asyncio.wait_for(
+                    collect_stream(current_model, prompt, generation_config, on_text),
+                    timeout=timeout
+                )
             
             # Check if response has text
-            if not response.text or len(response.text.strip()) < 10:
+            if not text or len(text.strip()) < 10:
                 raise ValueError("Model returned empty or invalid response")
             
-            print(f"✅ Model {current_model} responded successfully")
-            return response, current_model
+            log.info("✅ Model %s responded successfully", current_model)
+            return text, current_model
             
         except asyncio.TimeoutError:
-            last_error = Exception(f"Model {current_model} timed out after {GENERATION_TIMEOUT}s")
-            print(f"⏱️ Timeout on {current_model}, trying next model...")
-            await asyncio.sleep(1)
+            last_error = Exception(f"Model {current_model} timed out after {timeout:.0f}s")
+            log.warning("⏱️ Timeout on %s, trying next model...", current_model)
             continue
             
         except Exception as e:
             last_error = e
             error_msg = str(e).lower()
             
-            print(f"❌ Error with {current_model}: {error_msg[:150]}")
+            log.warning("❌ Error with %s: %.150s", current_model, error_msg)
             
-            # If it's a quota error, try next model
-            if any(keyword in error_msg for keyword in ["429", "quota", "rate limit", "resource exhausted"]):
-                print(f"💤 Rate limit hit, waiting before next model...")
-                await asyncio.sleep(1)
+            # Key/permission errors fail the same way on every model
+            if is_fatal_error(e):
+                raise
+            # If it's a quota error, try next model right away
+            if is_quota_error(e):
+                log.warning("💤 Rate limit hit, trying next model...")
                 continue
             # If it's a model not found error, try next model
-            elif any(keyword in error_msg for keyword in ["not found", "invalid model", "model not available"]):
+            elif is_model_unavailable(e):
                 continue
             # For empty/invalid responses, try next model
             elif "empty" in error_msg or "invalid response" in error_msg:
-                print(f"⚠️ Invalid response, trying next model...")
+                log.warning("⚠️ Invalid response, trying next model...")
                 continue
             # For other errors, try next model but log it
             else:
-                print(f"⚠️ Unexpected error, trying next model...")
+                log.warning("⚠️ Unexpected error, trying next model...")
                 continue
     
     # If all models failed, raise the last error
@@ -204,223 +482,456 @@ async def generate_with_fallback(prompt: str, generation_config: dict, model_nam
     else:
         raise Exception("All models failed to generate content")
 
-# Endpoints
-@app.get("/")
-async def root():
-    return {"message": "Exam Paper Generator API is running", "status": "healthy"}
-
-@app.get("/health")
-async def health_check():
-    """Health check endpoint that also lists available models"""
-    available_models = list_available_models()
-    return {
-        "status": "healthy", 
-        "api": "operational",
-        "available_models": available_models[:5] if available_models else []
-    }
+# Response cache helpers
+def cache_key(request: QuestionRequest) -> str:
+    """Normalized hash of the request fields"""
+    topics = sorted(t.strip() for t in request.topicHeadings.split(',') if t.strip())
+    raw = f"{request.courseName.strip()}|{request.examType}|{topics}".lower()
+    return hashlib.blake2b(raw.encode()).hexdigest()
 
-@app.post("/api/generate-questions")
-async def generate_questions(request: QuestionRequest):
+async def embed_request(request: QuestionRequest):
+    """Embed the course and topics for semantic lookups (None if embedding fails)"""
     try:
-        print(f"\n📝 New request: {request.examType} for {request.courseName}")
-        
-        # Determine exam parameters based on type
-        if request.examType in ["MST-1", "MST-2"]:
-            num_questions = 2
-            marks_ab = 3
-            marks_cd = 4
-            duration = "1 Hour"
-        else:  # End-Sem
-            num_questions = 5
-            marks_ab = 4
-            marks_cd = 6
-            duration = "3 Hours"
-        
-        # Split topics into a list
-        topics = [t.strip() for t in request.topicHeadings.split(',')]
-        
-        print(f"⚙️ Config: {num_questions} questions, Topics: {len(topics)}")
-        
-        # ============================================================
-        # PHASE 1: Generate outline (structure only - small & safe)
-        # ============================================================
-        print(f"\n📋 PHASE 1: Generating question outline...")
-        
-        outline_prompt = f"""You must generate ONLY valid JSON. No markdown, no explanations.
-
-Create an exam outline with {num_questions} questions.
+        result = await asyncio.wait_for(
+            client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=f"{request.courseName} | {request.topicHeadings}"
+            ),
+            timeout=EMBEDDING_TIMEOUT
+        )
+        vector = np.asarray(result.embeddings[0].values, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    except asyncio.TimeoutError:
+        log.warning("⏱️ Embedding timed out after %.1fs", EMBEDDING_TIMEOUT)
+        return None
+    except Exception as e:
+        log.warning("⚠️ Could not embed request: %.150s", e)
+        return None
 
-Course: {request.courseName}
-Topics: {request.topicHeadings}
+async def get_cached_response(key: str) -> Optional[dict]:
+    """Exact-match lookup"""
+    async with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] <= time.monotonic():
+            del _CACHE[key]
+            return None
+        _CACHE.move_to_end(key)
+        return entry["response"]
 
-Return ONLY this JSON array (no other text):
-[
-  {{"questionNumber": 1, "topic": "topic1"}},
-  {{"questionNumber": 2, "topic": "topic2"}}
-]
+async def get_similar_response(exam_type: str, embedding) -> Optional[dict]:
+    """Near-match lookup by cosine similarity against cached requests of the same exam type"""
+    async with _CACHE_LOCK:
+        now = time.monotonic()
+        for key in [k for k, entry in _CACHE.items() if entry["expires"] <= now]:
+            del _CACHE[key]
+        best_key, best_score = None, SEMANTIC_CACHE_THRESHOLD
+        for key, entry in _CACHE.items():
+            if entry["examType"] != exam_type or entry["embedding"] is None:
+                continue
+            score = float(np.dot(entry["embedding"], embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        _CACHE.move_to_end(best_key)
+        return _CACHE[best_key]["response"]
 
-Rules:
-- Each question uses a DIFFERENT topic from: {request.topicHeadings}
-- Output ONLY the JSON array
-- No markdown, no code blocks, no explanations"""
+async def store_cached_response(key: str, exam_type: str, embedding, response: dict):
+    """Insert a response, evicting the least recently used entry when full"""
+    async with _CACHE_LOCK:
+        _CACHE[key] = {
+            "examType": exam_type,
+            "embedding": embedding,
+            "response": response,
+            "expires": time.monotonic() + RESPONSE_CACHE_TTL
+        }
+        _CACHE.move_to_end(key)
+        while len(_CACHE) > RESPONSE_CACHE_SIZE:
+            _CACHE.popitem(last=False)
 
-        outline_config = genai.types.GenerationConfig(
-            temperature=0.3,
-            max_output_tokens=800,
-            candidate_count=1
+async def generate_paper(request: QuestionRequest, on_question=None) -> dict:
+    """Generate a full question paper, calling on_question as each question completes"""
+    # Determine exam parameters based on type
+    if request.examType in ["MST-1", "MST-2"]:
+        num_questions = 2
+        marks_ab = 3
+        marks_cd = 4
+        duration = "1 Hour"
+    else:  # End-Sem
+        num_questions = 5
+        marks_ab = 4
+        marks_cd = 6
+        duration = "3 Hours"
+    
+    # Split topics into a list
+    topics = [t.strip() for t in request.topicHeadings.split(',')]
+    
+    log.info("⚙️ Config: %d questions, Topics: %d", num_questions, len(topics))
+    
+    # ============================================================
+    # PHASE 1: Build outline (one topic per question, no LLM call)
+    # ============================================================
+    if len(topics) >= num_questions:
+        question_topics = random.sample(topics, num_questions)
+    else:
+        question_topics = [topics[i % len(topics)] for i in range(num_questions)]
+    outline = [
+        {"questionNumber": i + 1, "topic": topic}
+        for i, topic in enumerate(question_topics)
+    ]
+    # Replays start from the primary model unless the batch finds one that works
+    used_model = MODEL_FALLBACK_LIST[0]
+    
+    # ============================================================
+    # PHASE 2: Generate all questions in one batched call
+    # ============================================================
+    log.info("📝 PHASE 2: Generating all %d questions in one call...", num_questions)
+    
+    questions = {}
+    question_models = {}
+    fallback_numbers = set()
+    last_error = None
+    
+    def _accept(index: int, question_data, model_name: str) -> None:
+        """Record a valid question from the batch (first valid copy wins) and emit it"""
+        if index >= num_questions or index in questions:
+            return
+        if not isinstance(question_data, dict) or not isinstance(question_data.get('parts'), list):
+            return
+        question_data['questionNumber'] = index + 1
+        questions[index] = question_data
+        question_models[index + 1] = model_name
+        if on_question is not None:
+            on_question(question_data)
+    
+    def _on_text(text: str, model_name: str) -> None:
+        # Emit each array element as soon as its closing brace has streamed in
+        start = text.find('[')
+        if start < 0:
+            return
+        for index, blob in enumerate(_find_json_blobs(text[start + 1:])):
+            if index not in questions:
+                try:
+                    _accept(index, orjson.loads(blob), model_name)
+                except orjson.JSONDecodeError:
+                    continue
+    
+    topic_lines = "\n".join(f"  {q['questionNumber']}. Topic: {q['topic']}" for q in outline)
+    batch_prompt = f"""Paper request: generate {num_questions} questions.
+- Course: {request.courseName}
+- Marks: part a {marks_ab}, part b {marks_ab}, part c {marks_cd}
+- Questions:
+{topic_lines}"""
+    
+    try:
+        batch_text, used_model = await generate_with_fallback(
+            batch_prompt,
+            _BATCH_CFG,
+            on_text=_on_text
         )
+        batch = parse_model_json(batch_text)
+        if isinstance(batch, list):
+            for index, question_data in enumerate(batch):
+                _accept(index, question_data, used_model)
+    except Exception as e:
+        if is_fatal_error(e):
+            raise
+        last_error = e
+        log.warning("  ⚠️ Batched generation failed: %.100s", e)
+    
+    # Replay only the questions the batch did not deliver, one call each
+    missing = [q for i, q in enumerate(outline) if i not in questions]
+    if missing:
+        log.info("  ↳ Regenerating %d question(s) individually", len(missing))
+    
+    async def _gen_one(q_outline: dict) -> dict:
+        question = await _build_one(q_outline)
+        # Canned fallbacks are held back; they arrive with the finished paper (or not at all)
+        if on_question is not None and question['questionNumber'] not in fallback_numbers:
+            on_question(question)
+        return question
+    
+    async def _build_one(q_outline: dict) -> dict:
+        nonlocal last_error
+        q_num = q_outline['questionNumber']
+        topic = q_outline['topic']
         
-        outline_response, used_model = await generate_with_fallback(outline_prompt, outline_config)
-        outline = clean_and_parse_json(outline_response.text)
-        
-        # Validate outline is a list
-        if not isinstance(outline, list):
-            outline = [outline]
-        
-        # Ensure we have the right number of questions
-        outline = outline[:num_questions]
-        if len(outline) < num_questions:
-            # Generate missing questions
-            for i in range(len(outline), num_questions):
-                outline.append({
-                    "questionNumber": i + 1,
-                    "topic": topics[i % len(topics)]
-                })
-        
-        print(f"✅ Phase 1 complete: Generated outline for {len(outline)} questions")
-        
-        # ============================================================
-        # PHASE 2: Generate content per question (one at a time)
-        # ============================================================
-        print(f"\n📝 PHASE 2: Generating content for each question...")
-        
-        all_questions = []
-        
-        for q_outline in outline:
-            q_num = q_outline['questionNumber']
-            topic = q_outline.get('topic', topics[(q_num - 1) % len(topics)])
-            
-            print(f"  ↳ Generating Q{q_num} on topic: {topic}")
-            
-            content_prompt = f"""You must generate ONLY valid JSON. No markdown, no explanations.
-
-Generate ONE exam question:
+        content_prompt = f"""Question request:
 - Question Number: {q_num}
 - Topic: {topic}
 - Course: {request.courseName}
+- Marks: part a {marks_ab}, part b {marks_ab}, part c {marks_cd}"""
 
-Return ONLY this JSON (no other text):
-{{
-  "questionNumber": {q_num},
-  "parts": [
-    {{"label": "a", "text": "Define {topic}", "marks": {marks_ab}}},
-    {{"label": "b", "text": "Explain {topic}", "marks": {marks_ab}}},
-    {{"label": "c", "text": "Apply {topic}", "marks": {marks_cd}, "hasOR": true, "orText": "Analyze {topic}"}}
-  ]
-}}
-
-Rules:
-- Part a: Basic definition ({marks_ab} marks)
-- Part b: Explanation ({marks_ab} marks)
-- Part c: Application ({marks_cd} marks) with hasOR=true and orText
-- Make questions specific to: {topic}
-- Output ONLY JSON, no markdown"""
-
-            content_config = genai.types.GenerationConfig(
-                temperature=0.5,
-                max_output_tokens=1000,
-                candidate_count=1
-            )
-            
-            max_retries = 3
-            for retry in range(max_retries):
-                try:
-                    # Use the same model that worked for outline
-                    content_response, _ = await generate_with_fallback(
-                        content_prompt, 
-                        content_config, 
-                        model_name=used_model
-                    )
-                    
-                    question_data = clean_and_parse_json(content_response.text)
-                    
-                    # Validate structure
-                    if not isinstance(question_data, dict):
-                        raise ValueError("Invalid question structure")
-                    
-                    if 'parts' not in question_data:
-                        raise ValueError("Missing 'parts' in question data")
-                    
-                    # Ensure questionNumber is set
-                    question_data['questionNumber'] = q_num
-                    
-                    all_questions.append(question_data)
-                    print(f"  ✅ Q{q_num} generated successfully")
-                    break
-                    
-                except Exception as e:
-                    print(f"  ⚠️ Retry {retry + 1}/{max_retries} for Q{q_num}: {str(e)[:100]}")
-                    if retry == max_retries - 1:
-                        # Create a fallback question
-                        all_questions.append({
-                            "questionNumber": q_num,
-                            "parts": [
-                                {"label": "a", "text": f"Define {topic}", "marks": marks_ab},
-                                {"label": "b", "text": f"Explain the key concepts of {topic}", "marks": marks_ab},
-                                {"label": "c", "text": f"Apply {topic} in a real-world scenario", "marks": marks_cd, "hasOR": True, "orText": f"Analyze the benefits of {topic}"}
-                            ]
-                        })
-                        print(f"  ⚠️ Using fallback question for Q{q_num}")
-                    await asyncio.sleep(1)
-            
-            # Small delay between questions to avoid rate limits
-            if q_num < len(outline):
-                await asyncio.sleep(0.5)
-        
-        print(f"\n🎉 All {len(all_questions)} questions generated successfully!")
+        log.info("  ↳ Generating Q%d on topic: %s", q_num, topic)
         
+        max_retries = 3
+        model_name = used_model
+        deadline = time.monotonic() + RETRY_DEADLINE
+        for retry in range(max_retries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # Each attempt's timeout is capped by what is left of the retry budget
+                content_text, content_model = await generate_with_fallback(
+                    content_prompt, 
+                    _CONTENT_CFG, 
+                    model_name=model_name,
+                    timeout=min(GENERATION_TIMEOUT, remaining)
+                )
+                
+                question_data = parse_model_json(content_text)
+                
+                # Validate structure
+                if not isinstance(question_data, dict):
+                    raise ValueError("Invalid question structure")
+                
+                if 'parts' not in question_data:
+                    raise ValueError("Missing 'parts' in question data")
+                
+                # Ensure questionNumber is set
+                question_data['questionNumber'] = q_num
+                question_models[q_num] = content_model
+                
+                log.info("  ✅ Q%d generated successfully", q_num)
+                return question_data
+                
+            except Exception as e:
+                if is_fatal_error(e):
+                    raise
+                last_error = e
+                log.warning("  ⚠️ Retry %d/%d for Q%d: %.100s", retry + 1, max_retries, q_num, e)
+                if retry == max_retries - 1:
+                    break
+                if is_quota_error(e) or is_model_unavailable(e):
+                    # Quota spent, model missing or timed out; move on without waiting
+                    model_name = next_model(model_name)
+                    log.info("  🔀 Switching Q%d to %s", q_num, model_name)
+                    continue
+                # Exponential backoff with jitter
+                await asyncio.sleep(min(8, 0.2 * (2 ** retry) + random.random() * 0.2))
+    
+        # Create a fallback question
+        log.warning("  ⚠️ Using fallback question for Q%d", q_num)
+        fallback_numbers.add(q_num)
         return {
-            "success": True,
-            "questions": all_questions,
-            "message": "Questions generated successfully",
-            "examInfo": {
-                "duration": duration,
-                "numQuestions": num_questions
-            },
-            "modelUsed": used_model
+            "questionNumber": q_num,
+            "parts": [
+                {"label": "a", "text": f"Define {topic}", "marks": marks_ab},
+                {"label": "b", "text": f"Explain the key concepts of {topic}", "marks": marks_ab},
+                {"label": "c", "text": f"Apply {topic} in a real-world scenario", "marks": marks_cd, "hasOR": True, "orText": f"Analyze the benefits of {topic}"}
+            ]
         }
-        
-    except asyncio.TimeoutError:
-        print("⏱️ Request timed out")
+    
+    replayed = await asyncio.gather(*[_gen_one(q) for q in missing])
+    all_questions = sorted([*questions.values(), *replayed], key=lambda q: q['questionNumber'])
+    
+    # A paper made only of canned questions means generation failed outright
+    if len(fallback_numbers) == num_questions:
+        raise last_error or Exception("All models failed to generate content")
+    
+    log.info("🎉 All %d questions generated successfully!", len(all_questions))
+    
+    # Report the model that wrote most of the generated (non-fallback) questions
+    model_used = Counter(question_models.values()).most_common(1)[0][0]
+    
+    return {
+        "success": True,
+        "questions": all_questions,
+        "message": "Questions generated successfully",
+        "examInfo": {
+            "duration": duration,
+            "numQuestions": num_questions
+        },
+        "modelUsed": model_used,
+        "fallbackQuestions": sorted(fallback_numbers)
+    }
+
+async def resolve_paper(request: QuestionRequest, nocache: bool = False, on_question=None) -> dict:
+    """Serve a paper from the response cache, generating and caching it on a miss"""
+    key = cache_key(request)
+    if not nocache:
+        cached = await get_cached_response(key)
+        if cached is not None:
+            log.info("⚡ Cache hit (exact match)")
+            return cached
+
+    # Identical requests already being generated share that result and its question events
+    flight = _SINGLE_FLIGHT.get(key)
+    if flight is not None:
+        log.info("🔗 Joining in-flight generation of an identical request")
+        if on_question is None:
+            return await asyncio.shield(flight["future"])
+        # Catch up on questions already emitted, then follow the rest as they arrive
+        for question in flight["questions"]:
+            on_question(question)
+        flight["listeners"].append(on_question)
+        try:
+            return await asyncio.shield(flight["future"])
+        finally:
+            flight["listeners"].remove(on_question)
+
+    flight = {
+        "future": asyncio.get_running_loop().create_future(),
+        "questions": [],
+        "listeners": [] if on_question is None else [on_question]
+    }
+    _SINGLE_FLIGHT[key] = flight
+
+    def _broadcast(question: dict) -> None:
+        flight["questions"].append(question)
+        for listener in list(flight["listeners"]):
+            listener(question)
+
+    try:
+        response = await generate_and_cache(request, key, nocache, _broadcast)
+        flight["future"].set_result(response)
+        return response
+    except asyncio.CancelledError:
+        flight["future"].cancel()
+        raise
+    except Exception as e:
+        flight["future"].set_exception(e)
+        flight["future"].exception()  # mark retrieved so it is not logged when nobody joined
+        raise
+    finally:
+        _SINGLE_FLIGHT.pop(key, None)
+
+async def generate_and_cache(request: QuestionRequest, key: str, nocache: bool, on_question=None) -> dict:
+    """Semantic cache lookup, then generation under the in-flight cap"""
+    embedding = None if nocache else await embed_request(request)
+    if embedding is not None:
+        cached = await get_similar_response(request.examType, embedding)
+        if cached is not None:
+            log.info("⚡ Cache hit (semantic match)")
+            return cached
+
+    if _INFLIGHT.locked():
         raise HTTPException(
+            status_code=429,
+            detail="Server is busy generating other papers. Please try again shortly."
+        )
+    # Without an embedding from the lookup, compute one for storage alongside generation
+    embedding_task = None if embedding is not None else asyncio.create_task(embed_request(request))
+    try:
+        async with _INFLIGHT:
+            response = await generate_paper(request, on_question)
+        if embedding_task is not None:
+            embedding = await embedding_task
+    finally:
+        if embedding_task is not None:
+            embedding_task.cancel()
+    # Papers with canned fallback questions are served once but never cached
+    if not response["fallbackQuestions"]:
+        await store_cached_response(key, request.examType, embedding, response)
+    return response
+
+def to_http_exception(e: Exception) -> HTTPException:
+    """Map a generation failure to the HTTP error returned to clients"""
+    if isinstance(e, HTTPException):
+        return e
+    
+    if isinstance(e, asyncio.TimeoutError):
+        log.error("⏱️ Request timed out")
+        return HTTPException(
             status_code=504,
             detail="Request timed out. Please try again."
         )
-        
+    
+    error_msg = str(e)
+    log.error("🔥 INTERNAL ERROR: %s", error_msg)
+
+    # Check for quota/rate limit errors
+    if "429" in error_msg or "quota" in error_msg.lower():
+        return HTTPException(
+            status_code=429,
+            detail="API quota exceeded. Please try again later."
+        )
+    elif "API key" in error_msg:
+        return HTTPException(
+            status_code=401,
+            detail="Invalid API key configuration"
+        )
+    else:
+        return HTTPException(
+            status_code=500,
+            detail=f"Failed to generate questions: {error_msg}"
+        )
+
+# Startup
+@app.on_event("startup")
+async def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+@app.on_event("startup")
+async def setup_prompt_caches():
+    # Runs in the background so cache API calls never delay boot
+    app.state.prompt_cache_task = asyncio.create_task(prompt_cache_refresher())
+
+# Endpoints
+@app.get("/")
+async def root():
+    return {"message": "Exam Paper Generator API is running", "status": "healthy"}
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint that also lists available models"""
+    available_models = await run_in_threadpool(list_available_models)
+    return {
+        "status": "healthy", 
+        "api": "operational",
+        "available_models": available_models[:5] if available_models else []
+    }
+
+@app.post("/api/generate-questions")
+@limiter.limit(RATE_LIMIT)
+async def generate_questions(request: Request, payload: QuestionRequest, nocache: bool = False):
+    try:
+        log.info("📝 New request: %s for %s", payload.examType, payload.courseName)
+        return await resolve_paper(payload, nocache)
     except Exception as e:
-        error_msg = str(e)
-        print(f"🔥 INTERNAL ERROR: {error_msg}")
-
-        # Check for quota/rate limit errors
-        if "429" in error_msg or "quota" in error_msg.lower():
-            raise HTTPException(
-                status_code=429,
-                detail="API quota exceeded. Please try again later."
-            )
-        elif "API key" in error_msg:
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid API key configuration"
-            )
-        else:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to generate questions: {error_msg}"
-            )
+        raise to_http_exception(e)
+
+@app.post("/api/generate-questions/stream")
+@limiter.limit(RATE_LIMIT)
+async def generate_questions_stream(request: Request, payload: QuestionRequest, nocache: bool = False):
+    """Stream NDJSON events: one "question" per completed question, then "done" with the full paper"""
+    log.info("📝 New streaming request: %s for %s", payload.examType, payload.courseName)
+    
+    async def events():
+        events_queue = asyncio.Queue()
+        task = asyncio.create_task(resolve_paper(payload, nocache, on_question=events_queue.put_nowait))
+        task.add_done_callback(lambda _: events_queue.put_nowait(None))
+        try:
+            while (question := await events_queue.get()) is not None:
+                yield orjson.dumps({"type": "question", "question": question}) + b"\n"
+            yield orjson.dumps({"type": "done", **task.result()}) + b"\n"
+        except Exception as e:
+            error = to_http_exception(e)
+            yield orjson.dumps({"type": "error", "status": error.status_code, "detail": error.detail}) + b"\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 # Run the server
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    print(f"🚀 Starting server on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # In-process caches and limits are per worker
+    workers = int(os.getenv("WEB_CONCURRENCY", max(2, os.cpu_count() or 1)))
+    log.info("🚀 Starting server on port %d with %d workers", port, workers)
+    # "auto" picks uvloop/httptools when installed (uvicorn[standard], not on Windows).
+    # Workers need an import string; app_dir makes it resolve from any working directory
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="auto",
+        workers=workers
+        # X-Forwarded-For is trusted only from the proxies in FORWARDED_ALLOW_IPS
+        # (uvicorn reads it; default 127.0.0.1), so clients can't pick their rate-limit IP
+    )
\ No newline at end of file
@@ -50,9 +50,10 @@ const PaperVista = () => {
 
     setLoading(true);
     setError('');
+    setQuestions([]);
 
     try {
-      const response = await fetch(`${BACKEND_URL}/api/generate-questions`, {
+      const response = await fetch(`${BACKEND_URL}/api/generate-questions/stream`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -69,9 +70,38 @@ const PaperVista = () => {
         throw new Error(errorData.detail || `Backend Error: ${response.status}`);
       }
 
-      const data = await response.json();
+      // Read NDJSON events and render questions as they arrive
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let data = null;
+
+      const handleEvent = (line) => {
+        if (!line.trim()) return;
+        const event = JSON.parse(line);
+        if (event.type === 'question') {
+          setQuestions(prev => [
+            ...prev.filter(q => q.questionNumber !== event.question.questionNumber),
+            event.question
+          ].sort((a, b) => a.questionNumber - b.questionNumber));
+        } else if (event.type === 'done') {
+          data = event;
+        } else if (event.type === 'error') {
+          throw new Error(event.detail || `Backend Error: ${event.status}`);
+        }
+      };
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(handleEvent);
+      }
+      handleEvent(buffer);
 
-      if (data.success && data.questions) {
+      if (data && data.success && data.questions) {
         setQuestions(data.questions);
         setExamInfo(data.examInfo || examInfo);
         setBackendStatus('online');